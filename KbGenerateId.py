@@ -8,4 +8,12 @@ def generateId(prefix, counter):
     result = prefix + ":" + hashlib.sha224(str(counter).encode('utf-8')).hexdigest()[:10]
     return result
 
+def generateIds(prefix, first_counter, count):
+    if count <= 0:
+        return
+    prefix = prefix + ":"
+    sha224 = hashlib.sha224
+    for counter in range(first_counter, first_counter + count):
+        yield prefix + sha224(str(counter).encode('utf-8')).hexdigest()[:10]
+
 # konec souboru KbGenerateId.py
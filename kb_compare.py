@@ -29,11 +29,13 @@ import argparse
 import os
 import sys
 import time
-import copy
 import collections
+import contextlib
+import gc
 import itertools
+import operator
 
-from KbGenerateId import generateId
+from KbGenerateId import generateIds
 
 class KB(object):
     '''
@@ -83,6 +85,9 @@ class KB(object):
                 self.fields[self.name + "." + line] = Field(line_number, False)
             line_number += 1
         self.field_count = len(self.fields)
+        self.field_multiple = [False] * self.field_count # (MULTIPLE VALUES) flags by order numbers of fields
+        for field in self.fields.values():
+            self.field_multiple[field.order_num] = field.multiple
         fields_fd.close()
 
     def load_to_memory(self):
@@ -102,12 +107,11 @@ class KB(object):
         except IOError:
             printErr("Cannot open file " + self.file_name + ".")
             sys.exit(1)
-        self.entities = list()
-        for line in kb_fd:
-            entity = Entity(line.rstrip("\r\n"), self.separator, self.field_count)
+        with _gcPaused():
+            self.entities = [Entity(_parse_line(line.rstrip("\r\n"), self.separator, self.field_count)) for line in kb_fd]
             if freebase_idx is not None:
-                entity.fixFreebaseUrl(freebase_idx)
-            self.entities.append(entity)
+                for entity in self.entities:
+                    entity.fixFreebaseUrl(freebase_idx)
         kb_fd.close()
 
     def get_field_order_num(self, field_name):
@@ -122,6 +126,8 @@ class Field(object):
     Class for a value from *.fields config file.
     '''
 
+    __slots__ = ("order_num", "multiple")
+
     def __init__(self, order_num, multiple):
         self.order_num = order_num
         self.multiple  = multiple
@@ -131,24 +137,16 @@ class Entity(object):
     Data line container.
     """
     
-    def __init__(self, line, separator, field_count):
-        self.data    = line.split("\t")
+    __slots__ = ("data", "weight", "used", "matched")
+    
+    def __init__(self, data):
+        """
+        data - list of fields, each field is a list of values (see _parse_line())
+        """
+        self.data    = data
         self.weight  = 0
         self.used  = False
         self.matched = None
-        
-        if len(self.data) != field_count:
-            raise RuntimeError("len(self.data) != field_count \nself.data: %s" % (self.data))
-        
-        for i in range(field_count):
-            self.data[i] = self.data[i].split(separator)
-            for j in range(len(self.data[i])):
-                self.data[i][j] = self.data[i][j].strip()
-            self.data[i] = set(self.data[i])
-            if '' in self.data[i]:
-                self.data[i].remove('')
-            self.data[i] = list(self.data[i])
-        self.data = list(self.data)
     
     def __str__(self):
         return "%(self)r:\ndata==%(data)r\nmatched==%(matched)r\nused==%(used)r\nweight==%(weight)r\n" % {"self": self, "data": self.data, "matched": self.matched, "used": self.used, "weight": self.weight}
@@ -166,6 +164,17 @@ class Entity(object):
     def get_field(self, order_num):
         return self.data[order_num]
 
+def _parse_line(line, separator, field_count):
+    '''
+    Splits a KB line into fields. Every field is split by \a separator into a list
+    of stripped values without duplicates and empty strings (the order of values is kept).
+    '''
+    
+    data = line.split("\t")
+    if len(data) != field_count:
+        raise RuntimeError("len(data) != field_count \ndata: %s" % (data))
+    return [[value for value in dict.fromkeys(map(str.strip, field.split(separator))) if value] for field in data]
+
 class Relation(object):
     '''
     Class for a relation between 1st and 2nd KB.
@@ -175,6 +184,8 @@ class Relation(object):
     NAME = 2
     OTHER = 3
     
+    __slots__ = ("kb1_field", "kb2_field", "type", "blacklist")
+    
     def __init__(self, n1, n2, rel_type, blacklist=None):
         if blacklist is None:
             blacklist = set()
@@ -223,6 +234,23 @@ def parse_relations(rel_conf_file_name, kb1, kb2):
     rel_fd.close()
     return relations
 
+@contextlib.contextmanager
+def _gcPaused():
+    '''
+    Pauses the cyclic garbage collector while building large data without reference cycles (entities,
+    indexes), which the collector would otherwise traverse again and again. The built data are moved
+    to the permanent generation of the collector afterwards (they are still freed by reference counting).
+    '''
+    
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+        gc.freeze()
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
 def printErr(*args, **kwargs):
     if "file" not in kwargs:
         kwargs["file"] = sys.stderr
@@ -253,25 +281,53 @@ def _make_index(kb_entities, kb_field_count, relations, kb_field):
     
     index = [x for x in range(kb_field_count + 1)]
     
-    # fulfills dicts with default empty dict
-    for field in fields_to_index:
-        index[field] = dict()
-    
-    # iterates over KB lines and add terms to index
-    for entity in kb_entities:
+    with _gcPaused():
         for field in fields_to_index:
-            value = entity.get_field(field)
-            if (not value): # skips empty value
-                continue
-            for one_value in value:
-                # odfiltrování falešných unikátů
-                if one_value in blackdict[field]:
-                    continue
-                
-                # saves reference
-                index[field].setdefault(one_value, set()).add(entity)
+            blacklist = blackdict[field]
+            
+            # iterates over KB lines and collects references to entities for every value
+            postings = collections.defaultdict(list)
+            for entity in kb_entities:
+                for one_value in entity.data[field]:
+                    # odfiltrování falešných unikátů
+                    if one_value not in blacklist:
+                        postings[one_value].append(entity)
+            
+            # a value of a single entity (the common case) refers directly to the entity
+            for value, entities in postings.items():
+                if len(entities) > 1:
+                    entities = set(entities)
+                postings[value] = entities.pop() if len(entities) == 1 else entities
+            # missing values are not added by lookups any more (without copying the postings)
+            postings.default_factory = None
+            index[field] = postings
     return index
 
+def _iter_posting(posting):
+    '''
+    Returns entities referenced by an index \a posting (None, a single Entity or a set of at least two entities).
+    '''
+    
+    if posting is None:
+        return ()
+    if posting.__class__ is Entity:
+        return (posting,)
+    return posting
+
+def _add_to_posting(index_field, value, entity):
+    '''
+    Adds a reference to \a entity under \a value into \a index_field (an indexed field of an index).
+    '''
+    
+    posting = index_field.get(value)
+    if posting is None:
+        index_field[value] = entity
+    elif posting.__class__ is Entity:
+        if posting is not entity:
+            index_field[value] = {posting, entity}
+    else:
+        posting.add(entity)
+
 def get_args():
     """
     Parses arguments of the program. Returns an object of class argparse.Namespace.
@@ -327,12 +383,20 @@ def get_args():
         required=True)
     return parser.parse_args()
 
-def uniqifyList(seq, order_preserving=True):
-    if order_preserving:
-        seen = set()
-        return [x for x in seq if x not in seen and not seen.add(x)]
+def _mergeOutputValues(values, other_data, other_fields, multiple):
+    '''
+    Returns unique \a values of an output field of a matched entity. The values are completed by values
+    of \a other_fields from \a other_data (data of the matched entity from the other KB) if the field
+    has multiple values or if \a values are empty. A field without multiple values gets one value at most.
+    '''
+    
+    if other_fields and (multiple or not values):
+        values = list(set(itertools.chain(values, itertools.chain.from_iterable(map(other_data.__getitem__, other_fields)))))
     else:
-        return list(set(seq))
+        values = list(set(values))
+    if not multiple and len(values) > 1:
+        values = values[0:1]
+    return values
 
 def countNonEmptyFields(entity):
     count = 0
@@ -344,12 +408,14 @@ def countNonEmptyFields(entity):
 def deduplicate(kb, id_fields, blacklist_of_uniques=None):
     '''
     Deduplicate \a kb according to \a id_fields.
+    
+    blacklist_of_uniques - defaultdict(set), gets ids (by field order numbers) found to be corrupted
     '''
     relations = _getIdRelations(kb, id_fields)
     
     begin = time.time()
     index_for_kb = make_index_for_kb1(kb.entities, kb.field_count, relations)
-    sys.stdout.write("Deduplication: The index for KB "+kb.name+" was created (" + str(round(time.time() - begin, 2)) + " s).\n")
+    print(f"Deduplication: The index for KB {kb.name} was created ({time.time() - begin:.2f} s).")
     
     return _deduplicate(kb, index_for_kb, relations, "kb1_field", blacklist_of_uniques)
 
@@ -367,55 +433,74 @@ def _getIds(id_fields, entity, blacklist=None):
     result = []
     for field_idx in id_fields:
         unique_ids = entity.get_field(field_idx)
-        result.extend((field_idx, id) for id in unique_ids if blacklist is None or (field_idx, id) not in blacklist)
+        if blacklist is None:
+            result.extend((field_idx, id) for id in unique_ids)
+        else:
+            black_ids = blacklist[field_idx]
+            result.extend((field_idx, id) for id in unique_ids if id not in black_ids)
     return result
 
-def _collectIds(dest_unique_ids_dict, entity, index_for_kb):
+def _collectIds(dest_unique_ids_dict, root_entity, index_for_kb):
     # Touto funkcí můžeme získat více různých odkazů na wikipedii, jsou-li v KB špatné informace. Pokud se tomu chceme vyhnout je lepší použít funkci _collectUniqueIds().
-    for (field_idx, id) in _getIds(dest_unique_ids_dict.keys(), entity):
-        if id not in dest_unique_ids_dict[field_idx]:
-            dest_unique_ids_dict[field_idx].add(id)
-            for match in index_for_kb[field_idx].get(id):
-                _collectIds(dest_unique_ids_dict, match, index_for_kb)
+    visited = set()
+    fifo_entity = collections.deque()
+    fifo_entity.append(root_entity)
+    while fifo_entity:
+        entity = fifo_entity.popleft()
+        if entity in visited:
+            continue
+        visited.add(entity)
+        for (field_idx, id) in _getIds(dest_unique_ids_dict.keys(), entity):
+            if id not in dest_unique_ids_dict[field_idx]:
+                dest_unique_ids_dict[field_idx].add(id)
+                fifo_entity.extend(match for match in _iter_posting(index_for_kb[field_idx].get(id)) if match not in visited)
 
 def _collectUniqueIds(dest_unique_ids_dict, root_entity, index_for_kb, blacklist=None):
     if blacklist is None:
-        blacklist = set()
+        blacklist = collections.defaultdict(set)
     fifo_entity = collections.deque()
-    fifo_entity.append((root_entity, ""))
+    fifo_entity.append((root_entity, None, None))
     while fifo_entity:
-        entity, from_id = fifo_entity.popleft()
-        if from_id in blacklist:
+        entity, from_field_idx, from_id = fifo_entity.popleft()
+        if from_field_idx is not None and from_id in blacklist[from_field_idx]:
             continue
         cur_ids = _getIds(dest_unique_ids_dict.keys(), entity, blacklist)
         candidates_ids = []
         candidates_entities = []
         for (field_idx, id) in cur_ids:
-            if (field_idx, id) in blacklist: # blacklist může být změněn, proto je třeba jej stále kontrolovat
+            if id in blacklist[field_idx]: # blacklist může být změněn, proto je třeba jej stále kontrolovat
                 continue
             if id not in dest_unique_ids_dict[field_idx]:
                 if len(dest_unique_ids_dict[field_idx]):
                     # odstranění konfliktu a přidání konfliktních ID do blacklistu
-                    new_black_ids = [(_field_idx, _id) for (_field_idx, _id) in cur_ids if _id in dest_unique_ids_dict[_field_idx] and not(dest_unique_ids_dict[_field_idx].remove(_id))]
-                    blacklist.update(new_black_ids)
+                    for (_field_idx, _id) in cur_ids:
+                        if _id in dest_unique_ids_dict[_field_idx]:
+                            dest_unique_ids_dict[_field_idx].remove(_id)
+                            blacklist[_field_idx].add(_id)
                     candidates_ids.clear()
                     candidates_entities.clear()
                 else:
                     candidates_ids.append((field_idx, id))
-                    candidates_entities.extend(zip(index_for_kb[field_idx].get(id), itertools.repeat((field_idx, id))))
+                    candidates_entities.extend(zip(_iter_posting(index_for_kb[field_idx].get(id)), itertools.repeat(field_idx), itertools.repeat(id)))
         for (field_idx, id) in candidates_ids:
             dest_unique_ids_dict[field_idx].add(id)
         fifo_entity.extend(candidates_entities)
 
 def _deduplicate(kb, index_for_kb, relations, kb_field, blacklist=None):
+    '''
+    blacklist - dict of sets of ids by field order numbers, gets ids found to be corrupted (shared by different entities)
+    '''
     if blacklist is None:
-        blacklist = set()
+        blacklist = collections.defaultdict(set)
     
     unique_ids_fields_idx = set()
     for r in relations:
         if r.type == Relation.UNIQUE:
             unique_ids_fields_idx.add(getattr(r, kb_field))
     
+    # Více hodnot může mít pouze ten sloupec, který má příznak (MULTIPLE VALUES).
+    single_value_fields_idx = [field_idx for field_idx, multiple in enumerate(kb.field_multiple) if not multiple]
+    
     # going through entities from the 1st KB
     new_kb_entities = []
     for entity in kb.entities:
@@ -430,32 +515,29 @@ def _deduplicate(kb, index_for_kb, relations, kb_field, blacklist=None):
         matches = set()
         for field_idx in unique_ids_dict:
             for id in unique_ids_dict[field_idx]:
-                matches.update(index_for_kb[field_idx].get(id))
+                matches.update(_iter_posting(index_for_kb[field_idx].get(id)))
         matches = list(matches)
         
         if len(matches) > 1:
             # seřadit dle počtu neprázdných sloupců
             matches.sort(key=countNonEmptyFields, reverse=True)
-            new_entity = copy.copy(matches[0])
             for match in matches:
                 match.used = True # marked as used (can be used only once)
-                for field_idx in range(len(entity.data)):
-                    new_entity.data[field_idx].extend(match.data[field_idx])
-            new_entity.data = [uniqifyList(field, order_preserving=True) for field in new_entity.data]
+            # every field of the new entity holds unique values of the field from all matches (in order of matches)
+            new_entity = Entity([list(dict.fromkeys(itertools.chain.from_iterable(fields))) for fields in zip(*(match.data for match in matches))])
             
-            for field_head in kb.fields.values():
-                if not field_head.multiple: # Více hodnot může mít pouze ten sloupec, který má příznak (MULTIPLE VALUES).
-                    field = new_entity.data[field_head.order_num]
-                    if len(field) > 1:
-                        field = field[0:1]
-                        new_entity.data[field_head.order_num] = field
+            for field_idx in single_value_fields_idx:
+                field = new_entity.data[field_idx]
+                if len(field) > 1:
+                    new_entity.data[field_idx] = field[0:1]
             
             new_kb_entities.append(new_entity)
         else:
             new_kb_entities.append(entity)
     
     print("Deduplication: Number of removed entities ==", len(kb.entities) - len(new_kb_entities))
-    print("Deduplication: Created this blacklist of URIs as corrupted keys attributes ( length ==", len(blacklist), "):", sorted(blacklist))
+    black_ids = sorted((field_idx, id) for field_idx in blacklist for id in blacklist[field_idx])
+    print("Deduplication: Created this blacklist of URIs as corrupted keys attributes ( length ==", len(black_ids), "):", black_ids)
     kb.entities = new_kb_entities
 
 def _checkUnique(entity_from_kb1, entity_from_kb2, index_for_kb1, unique_relations):
@@ -463,16 +545,14 @@ def _checkUnique(entity_from_kb1, entity_from_kb2, index_for_kb1, unique_relatio
     Zkontroluje, zda po sjednocení \a entity_from_kb1 a \a entity_from_kb2 nedojde ke konfliktu identifikátorů. Následně je třeba index aktualizovat.
     '''
     
-    is_unique = True
+    # ids of the entity are looked up in the index (not vice versa), the first conflict decides
     for relation in unique_relations:
-        id_list = entity_from_kb2.get_field(relation.kb2_field)
-        for value in id_list:
-            if value:
-                matched_entities = index_for_kb1[relation.kb1_field].get(value, tuple())
-                if len(matched_entities) > 1 or len(matched_entities) == 1 and next(iter(matched_entities)) is not entity_from_kb1:
-                    is_unique = False
-                    break
-    return is_unique
+        index_field = index_for_kb1[relation.kb1_field]
+        for value in entity_from_kb2.get_field(relation.kb2_field):
+            posting = index_field.get(value)
+            if posting is not None and posting is not entity_from_kb1:
+                return False
+    return True
 
 def _getCheckUniqueErrorUriList(entity_from_kb1, entity_from_kb2, index_for_kb1, unique_relations):
     kb1 = set()
@@ -484,10 +564,10 @@ def _getCheckUniqueErrorUriList(entity_from_kb1, entity_from_kb2, index_for_kb1,
         kb2.update(id_list)
         for value in id_list:
             if value:
-                matched_entities = index_for_kb1[relation.kb1_field].get(value, tuple())
-                if len(matched_entities) > 1 or len(matched_entities) == 1 and next(iter(matched_entities)) is not entity_from_kb1:
+                posting = index_for_kb1[relation.kb1_field].get(value)
+                if posting is not None and posting is not entity_from_kb1:
                     is_unique = False
-                    for e in matched_entities:
+                    for e in _iter_posting(posting):
                         for r in unique_relations:
                             kb1.update(e.get_field(r.kb1_field))
     
@@ -509,9 +589,23 @@ def _updateUniqueInIndex(entity_from_kb1, index_for_kb1, unique_relations):
                     if value in relation.blacklist:
                         continue
                     else:
-                        index_for_kb1[relation.kb1_field].setdefault(value, set()).add(entity_from_kb1)
+                        _add_to_posting(index_for_kb1[relation.kb1_field], value, entity_from_kb1)
     return index_for_kb1
 
+def _tokenize(values):
+    '''
+    Splits \a values into a set of strings and a set of numbers for scoring of OTHER relations.
+    '''
+    
+    strings = set()
+    numbers = set()
+    for value in values:
+        try: # if string contains a number, the number will be rounded
+            numbers.add(round(float(value), 1))
+        except ValueError:
+            strings.add(value)
+    return strings, numbers
+
 def match(kb1, index_for_kb1, index_for_kb2, relations, treshold):
     '''
     Matches items from the 2nd KB with the corresponding items from the 1st KB.
@@ -528,9 +622,12 @@ def match(kb1, index_for_kb1, index_for_kb2, relations, treshold):
             name_relations.append(x)
         else:
             other_relations.append(x)
+    unique_pairs = [(r.kb1_field, r.kb2_field) for r in unique_relations]
+    other_pairs = [(r.kb1_field, r.kb2_field) for r in other_relations]
 
     # going through entities from the 1st KB
     for entity in kb1.entities:
+        data = entity.data
 
         # first, searching for a corresponding entry from the 2nd KB based on unique ids
         match = match_by_unique(entity, index_for_kb2, unique_relations)
@@ -557,37 +654,32 @@ def match(kb1, index_for_kb1, index_for_kb2, relations, treshold):
         if not candidates:
             continue
 
+        # non-empty unique ids of the entity, a candidate must not have a different one
+        unique_firsts = [(data[kb1_field][0], kb2_field) for kb1_field, kb2_field in unique_pairs if data[kb1_field]]
+        # non-empty values of the entity for OTHER relations, tokenized once for all candidates (when needed)
+        other_tokens = None
+
         # getting score for each candidate
         for candidate in candidates:
-            for relation in unique_relations:
-                first = entity.get_field(relation.kb1_field)
-                second = candidate.get_field(relation.kb2_field)
-                if first and second and first[0] != second[0]:
+            cand_data = candidate.data
+            for first, kb2_field in unique_firsts:
+                second = cand_data[kb2_field]
+                if second and first != second[0]:
                     candidate.weight = -1000
                     break
             
             # Předcházení konfliktu identifikátorů, tedy aby po sloučení dvou entit nevznikly nové konflikty
-            if not _checkUnique(entity, candidate, index_for_kb1, unique_relations):
+            if unique_relations and not _checkUnique(entity, candidate, index_for_kb1, unique_relations):
                 candidate.weight = -999
             
             # evaluating in name_relations was performed during the match_by_name function call
             if (candidate.weight < treshold): 
                 continue
-            for relation in other_relations:
-                first = entity.get_field(relation.kb1_field)
-                second = candidate.get_field(relation.kb2_field)
-                for i in first:
-                    for j in second:
-                        try: # if string contains a number, the number will be rounded 
-                            i = round(float(i), 1)
-                        except:
-                            pass
-                        try:
-                            j = round(float(j), 1)
-                        except:
-                            pass
-                        if i == j:
-                            candidate.weight += 1
+            if other_tokens is None:
+                other_tokens = [(_tokenize(data[kb1_field]), kb2_field) for kb1_field, kb2_field in other_pairs if data[kb1_field]]
+            for (first_strings, first_numbers), kb2_field in other_tokens:
+                second_strings, second_numbers = _tokenize(cand_data[kb2_field])
+                candidate.weight += len(first_strings & second_strings) + len(first_numbers & second_numbers)
 
         # choosing the best candidate (the one with the highest score)
         if candidates:
@@ -607,7 +699,8 @@ def match(kb1, index_for_kb1, index_for_kb2, relations, treshold):
             candidate.weight = 0
         
         # update index for kb1
-        _updateUniqueInIndex(entity, index_for_kb1, unique_relations)
+        if unique_relations:
+            _updateUniqueInIndex(entity, index_for_kb1, unique_relations)
 
 def match_by_unique(entity, index, unique_relations):
     '''
@@ -615,37 +708,36 @@ def match_by_unique(entity, index, unique_relations):
     '''
 
     for relation in unique_relations:
-        id_list = entity.get_field(relation.kb1_field)
-        for value in id_list:
-            if value:
-                match = index[relation.kb2_field].get(value, tuple())
-                for e in match:
-                    if not e.used:
-                        return e
-    return None               
+        index_field = index[relation.kb2_field]
+        for value in entity.get_field(relation.kb1_field):
+            for e in _iter_posting(index_field.get(value)):
+                if not e.used:
+                    return e
+    return None
 
 def match_by_name(entity, index, name_relations):
     '''
     Searches over the index for the corresponding entities based on the name comparison.
     '''
 
-    candidates = set()
+    # candidates are kept in the order of their first hit
+    candidates = dict()
     for relation in name_relations:
-        name_list = entity.get_field(relation.kb1_field)
-        for value in name_list: # if empty, we have to take another relation
-            if value:
-                match = index[relation.kb2_field].get(value, tuple())
-                for e in match:
-                    if not e.used:
-                       e.weight += 1
-                       candidates.add(e)
-    return candidates
+        index_field = index[relation.kb2_field]
+        for value in entity.get_field(relation.kb1_field): # if empty, we have to take another relation
+            for e in _iter_posting(index_field.get(value)):
+                if not e.used:
+                    e.weight += 1
+                    candidates[e] = None
+    return list(candidates)
  
 class Output(object):
     '''
     Class for creating the output.
     '''
 
+    BUFFER_SIZE = 1 << 18 # lines are written to the output files in chunks of at least this number of characters
+
     def __init__(self, output_conf_file_name, other_output_conf_file_name, output_file_name, second_output_file_name=None):
         try:
             output_conf_fd = open(output_conf_file_name, 'r')
@@ -681,14 +773,14 @@ class Output(object):
 
         os.makedirs(os.path.dirname(output_file_name), exist_ok=True)
         try:
-            self.output_fd = open(output_file_name, 'w')
+            self.output_fd = open(output_file_name, 'w', buffering=1 << 20, newline='')
         except IOError:
             printErr("Cannot open file " + output_file_name + ".")
             sys.exit(1)
 
         if second_output_file_name is not None:
             try:
-                self.second_output_fd = open(second_output_file_name, 'w')
+                self.second_output_fd = open(second_output_file_name, 'w', buffering=1 << 20, newline='')
             except IOError:
                 printErr("Cannot open file " + second_output_file_name + ".")
                 sys.exit(1)
@@ -698,12 +790,84 @@ class Output(object):
 
         self.output_fields = output_fields
         self.other_output_fields = other_output_fields
+        self._out_buf = list()
+        self._out_len = 0
+        self._second_out_buf = list()
+        self._second_out_len = 0
+        # joins of output values and fields
+        self._pjoin = "|".join
+        self._tjoin = "\t".join
+
+    def _generateIds(self, count):
+        '''
+        Returns an iterator over \a count following IDs (they are generated on demand).
+        '''
 
-    def _generateId(self):
-        self.counter += 1
-        result = generateId(self.prefix, self.counter)
+        result = generateIds(self.prefix, self.counter + 1, count)
+        self.counter += count
         return result
 
+    def _compile_output_plans(self, kb1, kb2, relations):
+        '''
+        Compiles output fields for matched (output_fields) and unmatched (other_output_fields) entities
+        from the 1st KB into two lists of functions, each of them returns values of one output field
+        for a given entity.
+        '''
+
+        # fields of the other KB related to a field
+        kb1_to_kb2 = collections.defaultdict(list)
+        kb2_to_kb1 = collections.defaultdict(list)
+        for relation in relations:
+            kb1_to_kb2[relation.kb1_field].append(relation.kb2_field)
+            kb2_to_kb1[relation.kb2_field].append(relation.kb1_field)
+
+        plan_matched = list()
+        for fieldname in self.output_fields:
+            get_values = self._compile_constant_field(fieldname)
+            if get_values is None:
+                if fieldname.startswith(kb1.name):
+                    ff = kb1.fields[fieldname]
+                    # using values from the 2nd KB
+                    other_fields = kb1_to_kb2[ff.order_num]
+                    get_values = lambda line, order_num=ff.order_num, other_fields=other_fields, multiple=ff.multiple: \
+                        _mergeOutputValues(line.data[order_num], line.matched.data, other_fields, multiple)
+                else:
+                    ff = kb2.fields[fieldname]
+                    # using values from the 1st KB
+                    other_fields = kb2_to_kb1[ff.order_num]
+                    get_values = lambda line, order_num=ff.order_num, other_fields=other_fields, multiple=ff.multiple: \
+                        _mergeOutputValues(line.matched.data[order_num], line.data, other_fields, multiple)
+            plan_matched.append(get_values)
+
+        plan_unmatched = list()
+        for fieldname in self.other_output_fields:
+            get_values = self._compile_constant_field(fieldname)
+            if get_values is None:
+                fields = [kb1.get_field_order_num(fn) for fn in fieldname.split("|")]
+                if len(fields) == 1:
+                    get_values = lambda line, field=fields[0]: list(set(line.data[field]))
+                else:
+                    get_fields = operator.itemgetter(*fields)
+                    get_values = lambda line, get_fields=get_fields: list(set(itertools.chain.from_iterable(get_fields(line.data))))
+            plan_unmatched.append(get_values)
+
+        return plan_matched, plan_unmatched
+
+    def _compile_constant_field(self, fieldname):
+        '''
+        Returns a function generating values of an "ID", an empty (None) or a literal ("...") output field.
+        Returns None for fields taken from a KB.
+        '''
+
+        if (fieldname == "ID"):
+            return lambda line: [next(self._ids)]
+        elif (fieldname == None):
+            return lambda line: [""]
+        elif (fieldname.startswith('"')):
+            value = [fieldname.strip('"')]
+            return lambda line: value
+        return None
+
     def make_output(self, kb1, kb2, relations, prefix):
         '''
         Creates the output.
@@ -711,103 +875,119 @@ class Output(object):
 
         self.counter = 0 # global ID counter
         self.prefix = prefix
-        kb1_matched = 0
-        kb1_not_matched = 0
+        plan_matched, plan_unmatched = self._compile_output_plans(kb1, kb2, relations)
+        kb1_matched = sum(1 for line in kb1.entities if line.used)
+        kb1_not_matched = len(kb1.entities) - kb1_matched
+        self._ids = self._generateIds(kb1_matched * self.output_fields.count("ID") + kb1_not_matched * self.other_output_fields.count("ID"))
+        # rows are reused, write_line_to_output() joins their values before they are overwritten
+        matched = (list(enumerate(plan_matched)), [None] * len(plan_matched))
+        unmatched = (list(enumerate(plan_unmatched)), [None] * len(plan_unmatched))
         for line in kb1.entities:
-            generated_line = list()
-            if line.used:
-                kb1_matched += 1
-                for fieldname in self.output_fields:
-                    if (fieldname == "ID"):
-                        generated_line.append([self._generateId()])
-                    elif (fieldname == None):
-                        generated_line.append([""])
-                    elif (fieldname.startswith('"')):
-                        generated_line.append([fieldname.strip('"')])
-                    else:
-                        possible = list()
-                        if fieldname.startswith(kb1.name):
-                            ff = kb1.fields[fieldname]
-                            possible.extend(line.get_field(ff.order_num))
-                            if ff.multiple or len(possible) == 0 : # using values from the 2nd KB
-                                for relation in relations:
-                                    if relation.kb1_field == ff.order_num:
-                                        possible.extend(line.matched.get_field(relation.kb2_field)) 
-                        else:
-                            ff = kb2.fields[fieldname]
-                            if not line.matched:
-                                print(line)
-                            possible.extend(line.matched.get_field(ff.order_num))
-                            if ff.multiple or len(possible) == 0 : # using values from the 1st KB
-                                for relation in relations:
-                                    if relation.kb2_field == ff.order_num:
-                                        possible.extend(line.get_field(relation.kb1_field)) 
-                        possible = uniqifyList(possible, order_preserving=False)
-                        if not ff.multiple and len(possible) > 1:
-                            possible = possible[0:1]
-                        generated_line.append(possible)
-            else:
-                kb1_not_matched += 1
-                for fieldname in self.other_output_fields:
-                    if (fieldname == "ID"):
-                        generated_line.append([self._generateId()])
-                    elif (fieldname == None):
-                        generated_line.append([""])
-                    elif (fieldname.startswith('"')):
-                        generated_line.append([fieldname.strip('"')])
-                    else:
-                        possible = list()
-                        for fn in fieldname.split("|"):
-                            field = kb1.get_field_order_num(fn)
-                            possible.extend(line.get_field(field))
-                        possible = uniqifyList(possible, order_preserving=False)
-                        generated_line.append(possible)
+            plan, generated_line = matched if line.used else unmatched
+            for i, get_values in plan:
+                generated_line[i] = get_values(line)
             self.write_line_to_output(generated_line)
-        sys.stdout.write("Matched entities : " + str(kb1_matched) + ".\n")
-        sys.stdout.write("Unmatched entities from the 1st KB : " + str(kb1_not_matched) + ".\n")
+        print(f"Matched entities : {kb1_matched}.")
+        print(f"Unmatched entities from the 1st KB : {kb1_not_matched}.")
         if self.second_output:
             self.generate_rest(kb2.entities)
         else:
-            self.generate_second(kb2.entities, self.output_fields, kb2.name, kb2.fields)
+            row, plan = self._compile_second_plan(self.output_fields, kb2.name, kb2.fields)
+            self.generate_second(kb2.entities, row, plan)
+        self.flush()
         self.output_fd.close()
+        if self.second_output:
+            self.second_output_fd.close()
 
     def write_line_to_output(self, line):
-        result = "\t".join("|".join(field) for field in line) + "\n"
-        self.output_fd.write(result)
+        result = self._tjoin(map(self._pjoin, line)) + "\n"
+        self._out_buf.append(result)
+        self._out_len += len(result)
+        if self._out_len >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes buffered lines into the output files.
+        '''
 
-    def generate_second(self, data, output, kb, fields_in_kb2):
-        kb2_not_matched = 0
-        for line in data:
-            if line.used:
+        if self._out_buf:
+            self.output_fd.write("".join(self._out_buf))
+            self._out_buf.clear()
+            self._out_len = 0
+        if self._second_out_buf:
+            self.second_output_fd.write("".join(self._second_out_buf))
+            self._second_out_buf.clear()
+            self._second_out_len = 0
+
+    @staticmethod
+    def _compile_second_plan(output, kb, fields_in_kb2):
+        '''
+        Compiles output fields for unmatched entities from the 2nd KB into a row with empty fields and literals
+        and a list of (position, None) for IDs and (position, order number) for fields of the 2nd KB.
+        '''
+
+        row = [""] * len(output)
+        plan = list()
+        for i, fieldname in enumerate(output):
+            if (fieldname == "ID"):
+                plan.append((i, None))
+            elif (fieldname == None):
                 continue
-            kb2_not_matched += 1
-            result = []
-            for fieldname in output:
-                if (fieldname == "ID"):
-                    result.append(self._generateId())
-                elif (fieldname == None):
-                    result.append("")
-                elif (fieldname.startswith('"')):
-                    result.append(fieldname.strip('"'))
-                elif (not fieldname.startswith(kb)):
-                    result.append("")
-                else:
-                    result.append("|".join(line.get_field(fields_in_kb2[fieldname].order_num)))
-         
-            result = "\t".join(result) + "\n"
-            self.output_fd.write(result)
-        sys.stdout.write("Unmatched entities from the 2nd KB : " + str(kb2_not_matched) + ".\n")
+            elif (fieldname.startswith('"')):
+                row[i] = fieldname.strip('"')
+            elif (fieldname.startswith(kb)):
+                plan.append((i, fields_in_kb2[fieldname].order_num))
+        return row, plan
+
+    def generate_second(self, data, row, plan):
+        # the row is reused, only its positions in the plan are filled in for every entity
+        unmatched = [line for line in data if not line.used]
+        kb2_not_matched = len(unmatched)
+        if not unmatched:
+            print(f"Unmatched entities from the 2nd KB : {kb2_not_matched}.")
+            return
+        # names used in the loop are bound to locals
+        pjoin = "|".join
+        tjoin = "\t".join
+        gen_id = self._generateIds(kb2_not_matched * sum(1 for i, order_num in plan if order_num is None)).__next__
+        out_append = self._out_buf.append
+        out_len = self._out_len
+        buffer_size = self.BUFFER_SIZE
+        for line in unmatched:
+            line_data = line.data
+            for i, order_num in plan:
+                row[i] = gen_id() if order_num is None else pjoin(line_data[order_num])
+            result = tjoin(row) + "\n"
+            out_append(result)
+            out_len += len(result)
+            if out_len >= buffer_size:
+                self.flush()
+                out_len = 0
+        self._out_len = out_len
+        print(f"Unmatched entities from the 2nd KB : {kb2_not_matched}.")
 
     def generate_rest(self, entities):
-        sys.stdout.write("Unmatched entities from the 2nd KB were written into the separate file.\n")
-        kb2_not_matched = 0
-        for e in entities:
-            if e.used:
-                continue
-            kb2_not_matched += 1
-            line = "\t".join("|".join(field) for field in e.data) + "\n"
-            self.second_output_fd.write(line)
-        sys.stdout.write("Unmatched from the 2nd KB " + str(kb2_not_matched) + ".\n")
+        print("Unmatched entities from the 2nd KB were written into the separate file.")
+        unmatched = [e.data for e in entities if not e.used]
+        kb2_not_matched = len(unmatched)
+        if not unmatched:
+            print(f"Unmatched from the 2nd KB {kb2_not_matched}.")
+            return
+        pjoin = "|".join
+        tjoin = "\t".join
+        out_append = self._second_out_buf.append
+        out_len = self._second_out_len
+        buffer_size = self.BUFFER_SIZE
+        for data in unmatched:
+            line = tjoin(map(pjoin, data)) + "\n"
+            out_append(line)
+            out_len += len(line)
+            if out_len >= buffer_size:
+                self.flush()
+                out_len = 0
+        self._second_out_len = out_len
+        print(f"Unmatched from the 2nd KB {kb2_not_matched}.")
 
 def main():
     args = get_args()
@@ -817,59 +997,53 @@ def main():
     kb1 = KB(args.first, args.first_fields, args.first_sep)
     kb1.load_config()
     kb1.load_to_memory()
-    sys.stdout.write("The 1st KB, " + kb1.name + ", was loaded into memory (" + str(round(time.time() - begin, 2)) + " s).\n")
+    print(f"The 1st KB, {kb1.name}, was loaded into memory ({time.time() - begin:.2f} s).")
     
     begin = time.time()
     kb2 = KB(args.second, args.second_fields, args.second_sep)
     kb2.load_config()
     kb2.load_to_memory()
-    sys.stdout.write("The 2nd KB, " + kb2.name + ", was loaded into memory (" + str(round(time.time() - begin, 2)) + " s).\n")
+    print(f"The 2nd KB, {kb2.name}, was loaded into memory ({time.time() - begin:.2f} s).")
     
     relations = parse_relations(args.rel_conf, kb1, kb2)
     
     if args.deduplicate_kb1:
-        blacklist_of_uniques = set()
+        blackdict_of_uniques = collections.defaultdict(set)
         
         begin = time.time()
-        deduplicate(kb1, args.id_fields, blacklist_of_uniques)
-        sys.stdout.write("The 1st KB, " + kb1.name + ", was successfully deduplicated (" + str(round(time.time() - begin, 2)) + " s).\n")
+        deduplicate(kb1, args.id_fields, blackdict_of_uniques)
+        print(f"The 1st KB, {kb1.name}, was successfully deduplicated ({time.time() - begin:.2f} s).")
         
-        blackdict_of_uniques = dict()
-        for field_idx, value in blacklist_of_uniques:
-            blackdict_of_uniques.setdefault(field_idx, set()).add(value)
         for r in relations:
             if r.type == Relation.UNIQUE and r.kb1_field in blackdict_of_uniques:
                 r.blacklist.update(blackdict_of_uniques[r.kb1_field])
     
     if args.deduplicate_kb2:
-        blacklist_of_uniques = set()
+        blackdict_of_uniques = collections.defaultdict(set)
         
         begin = time.time()
-        deduplicate(kb2, args.id_fields, blacklist_of_uniques)
-        sys.stdout.write("The 2nd KB, " + kb2.name + ", was successfully deduplicated (" + str(round(time.time() - begin, 2)) + " s).\n")
+        deduplicate(kb2, args.id_fields, blackdict_of_uniques)
+        print(f"The 2nd KB, {kb2.name}, was successfully deduplicated ({time.time() - begin:.2f} s).")
         
-        blackdict_of_uniques = dict()
-        for field_idx, value in blacklist_of_uniques:
-            blackdict_of_uniques.setdefault(field_idx, set()).add(value)
         for r in relations:
             if r.type == Relation.UNIQUE and r.kb2_field in blackdict_of_uniques:
                 r.blacklist.update(blackdict_of_uniques[r.kb2_field])
     
     begin = time.time()
     index_for_kb1 = make_index_for_kb1(kb1.entities, kb1.field_count, relations)
-    sys.stdout.write("The index for the 1st KB was created for compare (" + str(round(time.time() - begin, 2)) + " s).\n")
+    print(f"The index for the 1st KB was created for compare ({time.time() - begin:.2f} s).")
     
     begin = time.time()
     index_for_kb2 = make_index_for_kb2(kb2.entities, kb2.field_count, relations)
-    sys.stdout.write("The index for the 2nd KB was created for compare (" + str(round(time.time() - begin, 2)) + " s).\n")
+    print(f"The index for the 2nd KB was created for compare ({time.time() - begin:.2f} s).")
     
     begin = time.time()
     match(kb1, index_for_kb1, index_for_kb2, relations, int(args.treshold))
-    sys.stdout.write("KBs " + kb1.name + " and " + kb2.name + " were successfully compared (" + str(round(time.time() - begin, 2)) + " s).\n")
+    print(f"KBs {kb1.name} and {kb2.name} were successfully compared ({time.time() - begin:.2f} s).")
     
     begin = time.time()
     output_maker.make_output(kb1, kb2, relations, args.id_prefix)
-    sys.stdout.write("A new KB " + args.output + " was created (" + str(round(time.time() - begin, 2)) + " s).\n")
+    print(f"A new KB {args.output} was created ({time.time() - begin:.2f} s).")
     return 0
 
 if __name__ == "__main__":